@@ -41,6 +41,8 @@ function BookCard({ book, onSelect }) {
         <img
           src={imageUrl}
           alt={`Cover of ${title}`}
+          loading="lazy"
+          decoding="async"
           onError={handleImageError}
           className="w-full aspect-[2/3] object-cover"
         />